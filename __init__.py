@@ -1,8 +1,75 @@
-from .binary_search import BinarySearch
-from .cache import ModelDict, QueryResult, Variables, fill_obj_from_dict, model_to_dict, run_query
-from .common import GlobalConfig
-from .cond import IfStmt
-from .little_things import Min, Max
-from .my_solver import MySolver, extract_vars
-from .nonlinear import Piecewise
-from .small_denom import find_small_denom_soln
+''' Submodules are imported lazily, when one of their names is first used, so
+that short-lived processes only pay for what they use. For the same reason,
+the modules that only build constraints (`cond`, `nonlinear`) import the
+ones that run queries (`cube`, `parallel`, which pull in `cache` and
+multiprocessing) inside the functions that need them '''
+
+import importlib
+from typing import TYPE_CHECKING
+
+# Maps every public name to the submodule that defines it
+_names = {
+    "BinarySearch": "binary_search",
+    "ModelDict": "cache",
+    "QueryResult": "cache",
+    "Variables": "cache",
+    "fill_obj_from_dict": "cache",
+    "model_to_dict": "cache",
+    "run_query": "cache",
+    "GlobalConfig": "common",
+    "IfStmt": "cond",
+    "cubes_from_cases": "cube",
+    "cubes_from_guards": "cube",
+    "cubes_from_z3": "cube",
+    "product_cubes": "cube",
+    "run_query_cubes": "cube",
+    "Min": "little_things",
+    "Max": "little_things",
+    "MySolver": "my_solver",
+    "extract_vars": "my_solver",
+    "Piecewise": "nonlinear",
+    "ParallelChecker": "parallel",
+    "Preprocessed": "preprocessing",
+    "preprocess": "preprocessing",
+    "SolverSession": "session",
+    "find_small_denom_soln": "small_denom",
+    "sweep": "param_sweep",
+}
+
+# Submodules are also available as attributes (e.g. `pyz3_utils.cache`).
+# Every submodule defines at least one public name
+_submodules = set(_names.values())
+
+__all__ = list(_names)
+
+
+def __getattr__(name: str):
+    if name in _submodules:
+        # Importing a submodule also binds it in this module
+        return importlib.import_module("." + name, __name__)
+    if name not in _names:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    val = getattr(importlib.import_module("." + _names[name], __name__), name)
+    # Later lookups don't go through here
+    globals()[name] = val
+    return val
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | _submodules)
+
+
+if TYPE_CHECKING:
+    from .binary_search import BinarySearch
+    from .cache import ModelDict, QueryResult, Variables, fill_obj_from_dict, model_to_dict, run_query
+    from .common import GlobalConfig
+    from .cond import IfStmt
+    from .cube import cubes_from_cases, cubes_from_guards, cubes_from_z3, product_cubes, run_query_cubes
+    from .little_things import Min, Max
+    from .my_solver import MySolver, extract_vars
+    from .nonlinear import Piecewise
+    from .parallel import ParallelChecker
+    from .preprocessing import Preprocessed, preprocess
+    from .session import SolverSession
+    from .small_denom import find_small_denom_soln
+    from .param_sweep import sweep
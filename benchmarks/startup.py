@@ -0,0 +1,62 @@
+'''
+Measures the startup cost of short-lived processes that use pyz3_utils: the
+time to import the package (bare, and up to the first use of `MySolver` and
+`run_query`) in a fresh interpreter, and the per-call overhead of the library's
+logging when the messages are filtered out by level.
+
+Run with pyz3_utils importable, e.g. `python benchmarks/startup.py` from the
+directory containing the package.
+'''
+
+import logging
+import statistics
+import subprocess
+import sys
+import timeit
+
+
+def time_in_fresh_process(stmt: str, repeat: int) -> float:
+    '''Median wall-clock time of `stmt` in a new interpreter, in seconds'''
+    code = ("import time\n"
+            "start = time.perf_counter()\n"
+            f"{stmt}\n"
+            "print(time.perf_counter() - start)\n")
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], check=True,
+                             capture_output=True, text=True).stdout
+        times.append(float(out.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def main():
+    repeat = 10
+    print("Import times (median of %d fresh processes):" % repeat)
+    for (name, stmt) in [
+            ("import pyz3_utils", "import pyz3_utils"),
+            ("... + BinarySearch", "from pyz3_utils import BinarySearch"),
+            ("... + MySolver", "from pyz3_utils import MySolver"),
+            ("... + run_query", "from pyz3_utils import run_query"),
+            ("import everything", "from pyz3_utils import *")]:
+        print(f"  {name:20s} {time_in_fresh_process(stmt, repeat) * 1e3:8.2f} ms")
+
+    from pyz3_utils import GlobalConfig, MySolver
+    from pyz3_utils.common import logger
+    from z3 import And
+
+    GlobalConfig().logging_levels["pyz3_utils"] = logging.WARNING
+    GlobalConfig().reset_loggers()
+    s = MySolver()
+    xs = [s.Real(f"x{i}") for i in range(50)]
+    big = And(*[x >= i for (i, x) in enumerate(xs)])
+
+    n = 100000
+    t = timeit.timeit(lambda: logger.debug("Expression: %s", big), number=n)
+    print(f"Filtered logger.debug with a large argument: {t / n * 1e6:.3f} us/call")
+    n = 1000
+    t = timeit.timeit(lambda: s.check_expr(big), number=n)
+    print(f"MySolver.check_expr on a 50-variable expression: {t / n * 1e6:.3f} us/call")
+
+
+if __name__ == "__main__":
+    main()
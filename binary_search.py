@@ -1,5 +1,7 @@
 from typing import List, Optional, Tuple
 
+from .common import logger
+
 
 def sat_to_val(sat, reverse: bool = False):
     if sat == "sat":
@@ -9,7 +11,7 @@ def sat_to_val(sat, reverse: bool = False):
     elif sat == "unsat":
         val = 1
     else:
-        print(sat)
+        logger.error("Unknown satisfiability result %s", sat)
         assert(False)
     if reverse:
         val = 4 - val
@@ -6,7 +6,9 @@ because of timeout, makes note of that
 '''
 
 
-from .my_solver import MySolver
+from .common import logger
+from .my_solver import MySolver, TRACK_PREFIX, label_to_index, minimize_core,\
+    track_label
 from fractions import Fraction
 import hashlib
 import multiprocessing as mp
@@ -14,7 +16,7 @@ import os
 import pickle as pkl
 from typing import Dict, List, Optional, Union
 import z3
-from z3 import Solver, parse_smt2_string
+from z3 import Implies, Solver, parse_smt2_string
 
 
 class Variables:
@@ -29,12 +31,17 @@ class QueryResult:
         model: Optional[Dict[str, Union[float, bool]]],
         timeout: Optional[float],
         c,
-        v: Variables
+        v: Variables,
+        unsat_core: Optional[List[int]] = None,
+        core_minimized: bool = False
     ):
         ''' Arguments:
         satisfiable - one of 'sat', 'unsat', 'unknown'
         model - a map of variable assignments in the model
         timeout - If execution timed out, the timeout value in seconds
+        unsat_core - If unsat and the core was tracked, indices into
+            `MySolver.assertion_list` of the assertions in the core
+        core_minimized - Whether `unsat_core` was made minimal
         '''
         if timeout is not None:
             assert(satisfiable == "unknown")
@@ -44,6 +51,8 @@ class QueryResult:
         self.timeout = timeout
         self.c = c
         self.v = v
+        self.unsat_core = unsat_core
+        self.core_minimized = core_minimized
 
 
 ModelDict = Dict[str, Union[Fraction, bool, int]]
@@ -55,6 +64,9 @@ def model_to_dict(model: z3.ModelRef) -> ModelDict:
     decls = model.decls()
     res: ModelDict = {}
     for d in decls:
+        if d.name().startswith(TRACK_PREFIX):
+            # Unsat core tracking literals are not part of the problem
+            continue
         val = model[d]
         if type(val) == z3.BoolRef:
             res[d.name()] = bool(val)
@@ -64,7 +76,7 @@ def model_to_dict(model: z3.ModelRef) -> ModelDict:
             res[d.name()] = val.as_fraction()
         else:
             # Assume it is numeric
-            print(d.name(), type(val), val)
+            logger.debug("%s %s %s", d.name(), type(val), val.sexpr())
             res[d.name()] = val.as_fraction()
     return res
 
@@ -95,22 +107,120 @@ def fill_obj_from_dict(v, m: ModelDict):
     return res
 
 
-# Run the query in z3
+def cfg_defaults(c, s: MySolver) -> bool:
+    '''Add the options read when running queries to `c` if not already present.
+    Returns whether unsat cores should be tracked'''
+    if not hasattr(c, "unsat_core"):
+        c.unsat_core = False
+    if not hasattr(c, "minimize_core"):
+        c.minimize_core = False
+    return s.track_unsat or c.unsat_core
+
+
+def add_tracked(s: Solver, e: z3.BoolRef, i: int, track_unsat: bool,
+                labels: List[z3.BoolRef]):
+    '''Add the i-th assertion to `s`. If `track_unsat`, it is tracked by
+    `track_label(i)`, which is appended to `labels`'''
+    if track_unsat:
+        labels.append(track_label(i))
+        s.add(Implies(labels[-1], e))
+    else:
+        s.add(e)
+
+
+def core_indices(s: Solver, minimize: bool) -> List[int]:
+    '''Indices of the assertions in the unsat core of the last check on `s`,
+    whose assertions were added with `add_tracked`'''
+    core = s.unsat_core()
+    if minimize:
+        core = minimize_core(s, core)
+    return sorted(label_to_index(x) for x in core)
+
+
+# Run the query in z3. `assertion_list` is a list of SMT2 strings, each of
+# which may hold several assertions. Assertions are numbered in order
 def run(queue, assertion_list, track_unsat, c):
     s = Solver()
     s.set(unsat_core=track_unsat)
-    for (i, e) in enumerate(assertion_list):
-        e = parse_smt2_string(e)[0]
-        s.assert_and_track(e, f"{str(e)} :{i}")
-    satisfiable = s.check()
-    if c.unsat_core and str(satisfiable) == "unsat":
-        print(s.unsat_core())
+    labels: List[z3.BoolRef] = []
+    i = 0
+    for smt2 in assertion_list:
+        for e in parse_smt2_string(smt2):
+            add_tracked(s, e, i, track_unsat, labels)
+            i += 1
+    satisfiable = s.check(*labels)
     queue.put(str(satisfiable))
     if str(satisfiable) == "sat":
         model = model_to_dict(s.model())
         queue.put(model)
     else:
         queue.put(None)
+    if track_unsat and str(satisfiable) == "unsat":
+        queue.put(core_indices(s, c.minimize_core))
+    else:
+        queue.put(None)
+
+
+def expr_to_smt2(e) -> str:
+    s = Solver()
+    s.add(e)
+    return s.to_smt2()
+
+
+def cache_fname(smt2: str, dir: str) -> str:
+    '''The file in `dir` that caches the result of the query `smt2`'''
+    s_hash = hashlib.sha256(smt2.encode("utf-8")).digest().hex()[:16]
+    return dir + "/" + s_hash + ".cached"
+
+
+def read_cached(
+    fname: str,
+    timeout: float,
+    track_unsat: bool,
+    minimize_core: bool = False
+) -> Optional[QueryResult]:
+    '''Returns the cached result in `fname` if it is still valid for a query
+    with the given `timeout`. Else returns None. If `minimize_core`, an unsat
+    result is only valid if its core was minimized'''
+    if not os.path.exists(fname):
+        return None
+    try:
+        f = open(fname, 'rb')
+        res: QueryResult = pkl.load(f)
+        f.close()
+        # Results cached by older versions do not have `unsat_core` or
+        # `core_minimized`
+        core = getattr(res, "unsat_core", None)
+        minimized = getattr(res, "core_minimized", False)
+        if track_unsat and res.satisfiable == "unsat" and core is None:
+            # We need the core, which wasn't computed last time
+            pass
+        elif track_unsat and res.satisfiable == "unsat" and minimize_core\
+                and not minimized:
+            # We need a minimal core, which wasn't computed last time
+            pass
+        elif res.timeout is None:
+            # We got the result last time. Just return it
+            logger.debug("Cache hit")
+            return res
+        elif res.timeout >= timeout:
+            # Was the timeout last time >= timeout now? If so, we'll just
+            # timeout again. So return what we had last time
+            logger.debug("Cache hit")
+            return res
+    except Exception as e:
+        logger.warning("Exception while opening cached file %s: %s", fname, e)
+    return None
+
+
+def write_cached(fname: str, res: QueryResult):
+    try:
+        f = open(fname, 'wb')
+        logger.debug("Saving to %s", fname)
+        pkl.dump(res, f)
+        f.close()
+    except Exception as e:
+        logger.warning("Exception while saving to cached file %s: %s", fname, e)
 
 
 def run_query(
@@ -124,48 +234,48 @@ def run_query(
     `timeout` is the maximum execution time.
     `dir` is the directory in which all the cache files are stored (and will
         be stored by this function)
+
+    If `c.preprocess` is set, the problem is first preprocessed (see
+    `preprocess`) with the z3 tactics listed in `c.preprocess_tactics`.
     '''
 
-    # Add unsat_core to cfg if not already present
-    if not hasattr(c, "unsat_core"):
-        c.unsat_core = False
+    # Add the options we use to cfg if not already present
+    track_unsat = cfg_defaults(c, s)
+    if not hasattr(c, "preprocess"):
+        c.preprocess = False
+    if not hasattr(c, "preprocess_tactics"):
+        c.preprocess_tactics = None
+
+    # Optionally shrink the problem before it is hashed and shipped. The
+    # cache stores results for the preprocessed problem, which are mapped
+    # back to the original problem before being returned
+    pre = None
+    if c.preprocess:
+        from .preprocessing import preprocess
+        pre = preprocess(s, c.preprocess_tactics, track_unsat=track_unsat)
+        logger.info("%s", pre.report())
+        smt2 = pre.smt2
+        # One string, so that the definitions share a single preamble
+        assertion_list = [smt2]
+    else:
+        smt2 = s.to_smt2()
+        assertion_list = [expr_to_smt2(e) for e in s.assertion_list]
 
     # We also add cfg.simplify to the hash because simplification changes the
     # SMT output, and we don't want the caching mechanism to rely on the
     # correctness of anything other than the SMT solver
-    s_hash = hashlib.sha256(
-        (s.to_smt2()).encode("utf-8")
-    ).digest().hex()[:16]
-    fname = dir + "/" + s_hash + ".cached"
-    print(f"Cache file name: {fname}")
-    if not c.unsat_core and os.path.exists(fname):
-        # Read cached
-        try:
-            f = open(fname, 'rb')
-            res: QueryResult = pkl.load(f)
-            f.close()
-            if res.timeout is None:
-                # We got the result last time. Just return it
-                print("Cache hit")
-                return res
-            elif res.timeout >= timeout:
-                # Was the timeout last time >= timeout now? If so, we'll just
-                # timeout again. So return what we had last time
-                print("Cache hit")
-                return res
-        except Exception as e:
-            print("Warning: exception while opening cached file %s" % fname)
-            print(e)
+    fname = cache_fname(smt2, dir)
+    logger.debug("Cache file name: %s", fname)
+    cached = read_cached(fname, timeout, track_unsat, c.minimize_core)
+    if cached is not None:
+        if pre is not None:
+            return pre.map_result(cached, v)
+        return cached
 
     queue = mp.Manager().Queue()
 
-    def to_smt2(e):
-        s = Solver()
-        s.add(e)
-        return s.to_smt2()
-    assertion_list = [to_smt2(e) for e in s.assertion_list]
     proc = mp.Process(target=run,
-                      args=(queue, assertion_list, s.track_unsat, c))
+                      args=(queue, assertion_list, track_unsat, c))
     proc.start()
     proc.join(timeout)
     timed_out: bool = False
@@ -177,24 +287,21 @@ def run_query(
     if not timed_out:
         satisfiable = queue.get()
         model = queue.get()
+        core = queue.get()
         if satisfiable == "sat":
-            v = fill_obj_from_dict(v, model)
+            filled = fill_obj_from_dict(v, model)
         else:
-            v = None
-        res = QueryResult(satisfiable, model, None, c, v)
+            filled = None
+        res = QueryResult(satisfiable, model, None, c, filled, core,
+                          core is not None and c.minimize_core)
     else:
         res = QueryResult("unknown", None, timeout, c, None)
 
     proc.close()
 
     # Cache it for next time
-    try:
-        f = open(fname, 'wb')
-        print(fname)
-        pkl.dump(res, f)
-        f.close()
-    except Exception as e:
-        print("Warning: exception while saving to cached file %s" % fname)
-        print(e)
+    write_cached(fname, res)
 
+    if pre is not None:
+        return pre.map_result(res, v)
     return res
@@ -88,3 +88,35 @@ class GlobalConfig(metaclass=SingletonMeta):
 
         # add ch to logger
         logger.addHandler(handler)
+
+
+class LazyLogger:
+    '''Stands in for the `logging.Logger` called `name`. The logger is only set
+    up with `GlobalConfig().default_logger_setup` when it is first used, so
+    that importing a module does not install handlers. If the application
+    has configured the logger by then (a level or a handler), it is left
+    alone. Pass arguments
+    separately from the format string (e.g. `logger.debug("x = %s", x)`) so
+    they are only formatted if the message is emitted.
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.logger: Optional[logging.Logger] = None
+
+    def get(self) -> logging.Logger:
+        if self.logger is None:
+            self.logger = logging.getLogger(self.name)
+            if self.logger.level == logging.NOTSET\
+                    and len(self.logger.handlers) == 0:
+                GlobalConfig().default_logger_setup(self.logger)
+            else:
+                # Still reset by an explicit `GlobalConfig().reset_loggers()`
+                GlobalConfig().active_loggers.add(self.logger)
+        return self.logger
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+
+logger = LazyLogger('pyz3_utils')
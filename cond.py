@@ -1,9 +1,12 @@
-from typing import List, Tuple
+from typing import TYPE_CHECKING, List, Tuple
 from z3 import And, Implies, Not, Or
 import z3
 
 from .my_solver import MySolver
 
+if TYPE_CHECKING:
+    from .cube import Cube
+
 class IfStmt:
     # The compiled x => y pairs of (x, y)
     compiled: List[Tuple[z3.BoolRef, z3.BoolRef]]
@@ -59,6 +62,15 @@ class IfStmt:
         for (cond, stmt) in self.compiled:
             s.add(Implies(cond, stmt))
 
+    def cubes(self) -> List["Cube"]:
+        '''
+        Cubes that split a query along the branches of this if statement. See
+        `run_query_cubes`
+        '''
+
+        from .cube import cubes_from_cases
+        return cubes_from_cases(self.conds)
+
     def __add_stmts(self, cond: z3.BoolRef, stmts: List[z3.BoolRef]):
         for stmt in stmts:
             if type(stmt) == IfStmt:
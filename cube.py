@@ -0,0 +1,185 @@
+'''
+Cube-and-conquer: split a query into cubes (conjunctions of literals whose
+disjunction is valid), solve the cubes in parallel processes and combine the
+results. The query is sat as soon as any cube is sat and unsat once every cube
+is unsat. The combined result is cached just like `run_query` caches it, and
+each cube's result is cached separately so an interrupted run can resume.
+'''
+
+from .cache import QueryResult, cache_fname, cfg_defaults, expr_to_smt2,\
+    fill_obj_from_dict, read_cached, run, write_cached
+from .common import logger
+from .my_solver import MySolver
+import itertools
+import multiprocessing as mp
+import os
+import time
+from typing import List, Optional
+from z3 import And, BoolRef, Not, Or, Solver
+
+Cube = List[BoolRef]
+
+
+def cubes_from_guards(guards: List[BoolRef]) -> List[Cube]:
+    '''One cube for every truth assignment to `guards`. Produces
+    2^len(guards) cubes'''
+    return [list(c) for c in itertools.product(*[[g, Not(g)] for g in guards])]
+
+
+def cubes_from_cases(conds: List[BoolRef]) -> List[Cube]:
+    '''One cube per case of an if/elif chain over `conds` (e.g. `IfStmt.conds`
+    or the conditions of a `Piecewise`), plus one for the case where none of
+    them hold. The cubes are disjoint and cover everything even if the
+    conditions overlap or are not exhaustive'''
+    res = []
+    for i, cond in enumerate(conds):
+        if i == 0:
+            res.append([cond])
+        else:
+            res.append([Not(Or(*conds[:i])), cond])
+    res.append([Not(Or(*conds))])
+    return res
+
+
+def product_cubes(*cube_lists: List[Cube]) -> List[Cube]:
+    '''Combine several independent splits into one'''
+    return [sum(cs, []) for cs in itertools.product(*cube_lists)]
+
+
+def cubes_from_z3(s: MySolver, max_cubes: int = 8) -> List[Cube]:
+    '''Use z3's lookahead cuber to split `s` into at least `max_cubes` cubes
+    (if it can). Each round splits every cube once more'''
+    cubes: List[Cube] = [[]]
+    while len(cubes) < max_cubes:
+        new_cubes: List[Cube] = []
+        for cube in cubes:
+            cuber = Solver(ctx=s.ctx)
+            for e in s.assertion_list:
+                cuber.add(e)
+            for e in cube:
+                cuber.add(e)
+            split = [list(c) for c in cuber.cube()]
+            if len(split) == 0:
+                # z3 found this cube to be unsat. Keep it anyway so that the
+                # cubes still cover every case (needed for unsat cores)
+                split = [[]]
+            new_cubes += [cube + c for c in split]
+        if len(new_cubes) == len(cubes):
+            # No progress
+            break
+        cubes = new_cubes
+    return cubes
+
+
+def run_query_cubes(
+    c,
+    s: MySolver,
+    v,
+    cubes: List[Cube],
+    timeout: float = 10,
+    dir: str = "cached",
+    num_workers: Optional[int] = None
+) -> QueryResult:
+    '''Like `run_query`, but solves `s` by splitting it into `cubes`, which
+    must cover all cases (i.e. `Or(*[And(*cube) for cube in cubes])` must be
+    valid). Up to `num_workers` cubes are solved in parallel.
+
+    `timeout` is the maximum total execution time. Cubes that are not done by
+    then are unknown. If the query is unsat and the unsat core is tracked,
+    the core is the union of the cubes' cores. It is not minimal even if the
+    cubes' cores are.
+    '''
+
+    track_unsat = cfg_defaults(c, s)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    # The combined result is cached in the same file as `run_query`, since it
+    # is the answer to the same query
+    base_smt2 = s.to_smt2()
+    fname = cache_fname(base_smt2, dir)
+    logger.debug("Cache file name: %s", fname)
+    cached = read_cached(fname, timeout, track_unsat, c.minimize_core)
+    if cached is not None:
+        return cached
+
+    base_list = [expr_to_smt2(e) for e in s.assertion_list]
+    num_base = len(base_list)
+    cube_fnames = [cache_fname(base_smt2 + "\n; cube\n" + expr_to_smt2(And(*cube)),
+                               dir)
+                   for cube in cubes]
+
+    results: List[Optional[QueryResult]] = [None] * len(cubes)
+    for i in range(len(cubes)):
+        results[i] = read_cached(cube_fnames[i], timeout, track_unsat,
+                                 c.minimize_core)
+    pending = [i for i in range(len(cubes)) if results[i] is None]
+
+    manager = mp.Manager()
+    running = {}
+    deadline = time.time() + timeout
+
+    def is_sat(r: Optional[QueryResult]) -> bool:
+        return r is not None and r.satisfiable == "sat"
+
+    while not any(is_sat(r) for r in results)\
+            and (len(pending) > 0 or len(running) > 0)\
+            and time.time() < deadline:
+        while len(pending) > 0 and len(running) < num_workers:
+            i = pending.pop(0)
+            queue = manager.Queue()
+            assertion_list = base_list + [expr_to_smt2(e) for e in cubes[i]]
+            proc = mp.Process(target=run,
+                              args=(queue, assertion_list, track_unsat, c))
+            proc.start()
+            running[i] = (proc, queue, time.time())
+
+        for i in list(running.keys()):
+            proc, queue, start = running[i]
+            if proc.is_alive():
+                continue
+            proc.join()
+            proc.close()
+            del running[i]
+            satisfiable = queue.get()
+            model = queue.get()
+            core = queue.get()
+            if core is not None:
+                # Drop the cube's own literals
+                core = [j for j in core if j < num_base]
+            results[i] = QueryResult(satisfiable, model, None, c, None, core,
+                                     core is not None and c.minimize_core)
+            write_cached(cube_fnames[i], results[i])
+        time.sleep(0.01)
+
+    # Whatever is still running has either timed out or is no longer needed
+    timed_out = not any(is_sat(r) for r in results)
+    for i in running:
+        proc, queue, start = running[i]
+        proc.terminate()
+        proc.join()
+        proc.close()
+        if timed_out:
+            results[i] = QueryResult("unknown", None, deadline - start, c, None)
+            write_cached(cube_fnames[i], results[i])
+
+    sat_res = [r for r in results if is_sat(r)]
+    if len(sat_res) > 0:
+        model = sat_res[0].model
+        res = QueryResult("sat", model, None, c, fill_obj_from_dict(v, model))
+    elif all(r is not None and r.satisfiable == "unsat" for r in results):
+        core = None
+        if track_unsat:
+            core = sorted(set(j for r in results for j in r.unsat_core))
+        res = QueryResult("unsat", None, None, c, None, core)
+    else:
+        res = QueryResult("unknown", None, timeout, c, None)
+
+    # If some cubes never got to run, or got less than `timeout` because they
+    # started late, a rerun with the same timeout should try them rather than
+    # hit a cached unknown
+    if res.satisfiable != "unknown" or\
+            all(r is not None and (r.timeout is None or r.timeout >= timeout)
+                for r in results):
+        write_cached(fname, res)
+    return res
@@ -1,6 +1,12 @@
-from typing import Any, List, Set
-from z3 import ArithRef, Bool, BoolRef, Function, FuncDeclRef, Int, Real,\
-    Solver
+from typing import Any, List, Set, Tuple
+from z3 import ArithRef, Bool, BoolRef, Function, FuncDeclRef, Implies, Int,\
+    Real, Solver, unsat
+
+from .common import logger
+
+# Prefix of the Boolean literals used to track assertions for unsat cores.
+# The literal `f"{TRACK_PREFIX}{i}"` tracks the i-th assertion
+TRACK_PREFIX = "__track_"
 
 
 def extract_vars(e: BoolRef) -> List[str]:
@@ -19,6 +25,47 @@ def extract_vars(e: BoolRef) -> List[str]:
         return res
 
 
+def track_label(i: int, ctx=None) -> BoolRef:
+    '''The literal that tracks the i-th assertion'''
+    return Bool(f"{TRACK_PREFIX}{i}", ctx=ctx)
+
+
+def is_track_label(x: BoolRef) -> bool:
+    return x.decl().name().startswith(TRACK_PREFIX)
+
+
+def label_to_index(label: BoolRef) -> int:
+    '''Inverse of `track_label`'''
+    # Not `str(label)`: z3's printer is shared by all threads and is not
+    # thread safe
+    return int(label.decl().name()[len(TRACK_PREFIX):])
+
+
+def minimize_core(s: Solver, core: List[BoolRef],
+                  assumptions: List[BoolRef] = []) -> List[BoolRef]:
+    '''Deletion-based minimization of an unsat core. `core` is a list of
+    tracking literals (assumptions) under which `s` is unsat, together with
+    the fixed `assumptions`. Returns a subset of `core` from which no literal
+    can be removed while remaining unsat. Literals for which the solver
+    returns unknown are conservatively kept. On return, the last check on `s`
+    is the one with the minimal core.
+
+    '''
+    needed: List[BoolRef] = []
+    todo = list(core)
+    while len(todo) > 0:
+        x = todo.pop()
+        if s.check(*needed, *todo, *assumptions) == unsat:
+            # `x` is not needed. The solver may have found an even smaller
+            # core, so use it to prune the remaining candidates
+            in_core = set(y.decl().name() for y in s.unsat_core())
+            todo = [y for y in todo if y.decl().name() in in_core]
+        else:
+            needed.append(x)
+    s.check(*needed, *assumptions)
+    return needed
+
+
 class MySolver:
     '''A thin wrapper over z3.Solver'''
 
@@ -31,17 +78,37 @@ class MySolver:
         self.num_constraints = 0
         self.variables = {"False", "True"}
         self.track_unsat = False
+        # Tracking literals for the assertions added while `track_unsat` was
+        # set. These are passed as assumptions to every `check`
+        self.track_labels: List[BoolRef] = []
+        # The extra assumptions passed to the last `check`, which an unsat
+        # core may depend on
+        self.last_assumptions: List[BoolRef] = []
+        # The assertions as given to `add`. Use this rather than
+        # `assertions()`, which returns them wrapped in implications from
+        # their tracking literals when `track_unsat` is set
         self.assertion_list = []
         self.warn_undeclared = True
+        # One entry per `push`: the length of `assertion_list` and
+        # `track_labels` and the value of `num_constraints` at the time of the
+        # push, and the variables declared since. `pop` restores these
+        self.scopes: List[Tuple[int, int, int, List[str]]] = []
+
+    def declare_var(self, name: str):
+        if name in self.variables:
+            return
+        self.variables.add(name)
+        if len(self.scopes) > 0:
+            self.scopes[-1][3].append(name)
 
     def check_expr(self, expr):
         if(type(expr) == bool):
             return True
         for var in extract_vars(expr):
             if not self.warn_undeclared:
-                self.variables.add(var)
+                self.declare_var(var)
             if var not in self.variables:
-                print(f"Warning: {var} in {str(expr)} not previously declared")
+                logger.warning("%s in %s not previously declared", var, expr)
                 return False
         return True
 
@@ -49,8 +116,12 @@ class MySolver:
         assert self.check_expr(expr)
         self.assertion_list.append(expr)
         if self.track_unsat:
-            self.s.assert_and_track(expr,
-                                    str(expr) + f"  :{self.num_constraints}")
+            # Naming the assertion after `str(expr)` is very expensive for
+            # large expressions. Use an indexed literal instead. It is mapped
+            # back to the assertion only when a core is requested
+            label = track_label(len(self.assertion_list) - 1, self.ctx)
+            self.s.add(Implies(label, expr))
+            self.track_labels.append(label)
             self.num_constraints += 1
         else:
             self.s.add(expr)
@@ -60,22 +131,52 @@ class MySolver:
             self.track_unsat = True
         return self.s.set(**kwds)
 
-    def check(self):
-        return self.s.check()
+    def check(self, *assumptions):
+        self.last_assumptions = list(assumptions)
+        return self.s.check(*self.track_labels, *assumptions)
 
     def model(self):
         return self.s.model()
 
     def push(self):
         self.s.push()
-
-    def pop(self):
-        self.s.pop()
+        self.scopes.append((len(self.assertion_list), len(self.track_labels),
+                            self.num_constraints, []))
+
+    def pop(self, num: int = 1):
+        '''Pop `num` scopes, forgetting the assertions and variables added in
+        them'''
+        self.s.pop(num)
+        for _ in range(num):
+            (num_assertions, num_labels, num_constraints, declared) =\
+                self.scopes.pop()
+            del self.assertion_list[num_assertions:]
+            del self.track_labels[num_labels:]
+            self.num_constraints = num_constraints
+            self.variables.difference_update(declared)
 
     def unsat_core(self):
         # assert(self.track_unsat)
         return self.s.unsat_core()
 
+    def unsat_core_indices(self, minimize: bool = False) -> List[int]:
+        '''Indices into `assertion_list` of the assertions in the unsat core of
+        the last `check`. Only assertions added while `track_unsat` was set
+        can appear in the core. If `minimize`, the core is first made minimal
+        using additional solver calls, under the same extra assumptions as
+        the last `check`
+
+        '''
+        core = [x for x in self.s.unsat_core() if is_track_label(x)]
+        if minimize:
+            core = minimize_core(self.s, core, self.last_assumptions)
+        return sorted(label_to_index(x) for x in core)
+
+    def unsat_core_assertions(self, minimize: bool = False) -> List[BoolRef]:
+        '''Like `unsat_core_indices`, but returns the assertions themselves'''
+        return [self.assertion_list[i]
+                for i in self.unsat_core_indices(minimize)]
+
     def to_smt2(self):
         return self.s.to_smt2()
 
@@ -88,30 +189,50 @@ class MySolver:
     def translate(self, ctx):
         return self.s.translate(ctx)
 
+    def clone(self, ctx) -> "MySolver":
+        '''A copy of this solver in the context `ctx`, including the declared
+        `variables` and the unsat core tracking state. z3 contexts are not
+        thread safe, so this must be called from the thread that owns
+        `self.ctx`. The copy can then be used independently in another thread.
+        Open scopes are flattened: the copy starts with no scopes to pop
+
+        '''
+        res = MySolver(ctx)
+        res.s = self.s.translate(ctx)
+        res.s.set(unsat_core=self.track_unsat)
+        res.num_constraints = self.num_constraints
+        res.variables = set(self.variables)
+        res.track_unsat = self.track_unsat
+        res.track_labels = [x.translate(ctx) for x in self.track_labels]
+        res.assertion_list = [e if type(e) == bool else e.translate(ctx)
+                              for e in self.assertion_list]
+        res.warn_undeclared = self.warn_undeclared
+        return res
+
     def Real(self, name: str, ctx=None):
         assert ctx == self.ctx
         if name in self.variables:
-            print(f"Warning: {name} declared previously.")
-        self.variables.add(name)
+            logger.warning("%s declared previously.", name)
+        self.declare_var(name)
         return Real(name, ctx)
 
     def Function(self, name: str, t1, t2):
         if name in self.variables:
-            print(f"Warning: {name} declared previously.")
-        self.variables.add(name)
+            logger.warning("%s declared previously.", name)
+        self.declare_var(name)
         # Takes ctx from t1, t2
         return Function(name, t1, t2)
 
     def Int(self, name: str, ctx=None):
         assert ctx == self.ctx
         if name in self.variables:
-            print(f"Warning: {name} declared previously.")
-        self.variables.add(name)
+            logger.warning("%s declared previously.", name)
+        self.declare_var(name)
         return Int(name, ctx=ctx)
 
     def Bool(self, name: str, ctx=None):
         assert ctx == self.ctx
         if name in self.variables:
-            print(f"Warning: {name} declared previously.")
-        self.variables.add(name)
+            logger.warning("%s declared previously.", name)
+        self.declare_var(name)
         return Bool(name, ctx=ctx)
@@ -1,8 +1,11 @@
 from .my_solver import MySolver
-from typing import List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 import z3
 from z3 import And, ArithRef, BoolRef, If, Implies, Not, Sum
 
+if TYPE_CHECKING:
+    from .cube import Cube
+
 
 class Piecewise:
     '''
@@ -80,21 +83,41 @@ class Piecewise:
             self.s.add(Implies(c, aux == v + other))
         return aux
 
-    def verify(self, s: Optional[MySolver] = None):
+    def cubes(self) -> List["Cube"]:
+        '''Cubes that split a query into one case per piece. See
+        `run_query_cubes`'''
+        from .cube import cubes_from_cases
+        return cubes_from_cases([c for (c, _) in self.vals])
+
+    def verify(self, s: Optional[MySolver] = None,
+               num_threads: Optional[int] = None):
         '''Verify that the conditions are mutually exclusive and exhaustive. Takes an
         optional `MySolver` object that can contain additional constraints to
-        ensure this is the case.
+        ensure this is the case. If `num_threads` is given, exclusivity and
+        exhaustiveness are checked concurrently in separate threads.
 
         '''
         if s is None:
             s = MySolver()
 
         num_sat = sum([If(c, 1, 0) for (c, _) in self.vals])
-        s.push()
-        s.add(num_sat != 1)
-        satisfiable = s.check()
-        s.pop()
-        assert satisfiable != z3.unsat, f"Unable to check that options are mutually exclusive and exhaustive. Got {satisfiable} for {str(self.vals)}"
+        if num_threads is None:
+            s.push()
+            s.add(num_sat != 1)
+            satisfiable = s.check()
+            s.pop()
+        else:
+            from .parallel import ParallelChecker
+            with ParallelChecker(s, num_threads) as checker:
+                res = [r.satisfiable for r in
+                       checker.check([[num_sat == 0], [num_sat >= 2]])]
+            if "sat" in res:
+                satisfiable = z3.sat
+            elif "unknown" in res:
+                satisfiable = z3.unknown
+            else:
+                satisfiable = z3.unsat
+        assert satisfiable == z3.unsat, f"Unable to check that options are mutually exclusive and exhaustive. Got {satisfiable} for {str(self.vals)}"
 
 
 def create_linear_piecewise(start: float, end: float, step: float) -> Piecewise:
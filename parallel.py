@@ -0,0 +1,117 @@
+'''
+Runs independent checks on a `MySolver` concurrently in threads. Each thread
+gets its own z3 context holding a copy of the solver. z3 releases the GIL
+during `check`, so this gives in-process parallelism without pickling the
+problem or spawning processes like `run_query` does.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import List, Optional
+from z3 import BoolRef, Context
+
+from .cache import QueryResult, model_to_dict
+from .my_solver import MySolver
+
+
+# z3's value of the `timeout` parameter meaning no timeout
+NO_TIMEOUT = 4294967295
+
+
+def translate_expr(e, ctx):
+    if type(e) == bool:
+        return e
+    return e.translate(ctx)
+
+
+def check_all(s: MySolver, queries: List[List[BoolRef]],
+              timeout: Optional[float]) -> List[QueryResult]:
+    ''' Check `s` with each query's constraints added in turn. Runs in the
+    thread that owns `s.ctx`. z3's printer is shared by all threads and is
+    not thread safe, so nothing here may call `str` on a z3 object. In
+    particular, the queries are added directly to the underlying z3 solver
+    since `MySolver.add` prints their variables to check them. They are not
+    tracked and never appear in unsat cores '''
+    # Always set the timeout, since it persists across calls on the same clone
+    if timeout is not None:
+        s.set(timeout=int(timeout * 1000))
+    else:
+        s.set(timeout=NO_TIMEOUT)
+    res = []
+    for query in queries:
+        s.push()
+        for e in query:
+            s.s.add(e)
+        satisfiable = str(s.check())
+        model = None
+        core = None
+        timed_out = None
+        if satisfiable == "sat":
+            model = model_to_dict(s.model())
+        elif satisfiable == "unsat" and s.track_unsat:
+            core = s.unsat_core_indices()
+        elif timeout is not None and s.s.reason_unknown() in \
+                ["timeout", "canceled"]:
+            timed_out = timeout
+        res.append(QueryResult(satisfiable, model, timed_out, None, None,
+                               core))
+        s.pop()
+    return res
+
+
+class ParallelChecker:
+    ''' Holds one copy of a `MySolver` per thread, each in its own context. The
+    copies are made once, so many batches of queries can be checked against
+    the same base solver cheaply. Constraints added to the base solver after
+    construction are not seen by the copies.
+
+    Must be used from the thread that owns the base solver's context.
+    '''
+
+    def __init__(self, s: MySolver, num_threads: Optional[int] = None):
+        if num_threads is None:
+            num_threads = os.cpu_count() or 1
+        assert num_threads > 0
+        self.s = s
+        self.ctxs = [Context() for _ in range(num_threads)]
+        self.solvers = [s.clone(ctx) for ctx in self.ctxs]
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    def check(self, queries: List[List[BoolRef]],
+              timeout: Optional[float] = None) -> List[QueryResult]:
+        '''Check each query (a list of constraints in the base solver's context)
+        together with the base solver's assertions. Queries are independent of
+        each other. Returns one `QueryResult` per query, in order. Its `c` and
+        `v` are None, and its unsat core only refers to the base solver's
+        assertions. `timeout` is per query, in seconds.
+
+        '''
+        n = len(self.solvers)
+        # `check_all` cannot check the queries' variables, and translation
+        # reads the base context. So do both here rather than in the worker
+        # threads
+        for query in queries:
+            for e in query:
+                assert self.s.check_expr(e)
+        chunks = [[[translate_expr(e, self.ctxs[i]) for e in query]
+                   for query in queries[i::n]]
+                  for i in range(n)]
+        futures = [self.executor.submit(check_all, self.solvers[i], chunks[i],
+                                        timeout)
+                   for i in range(n)]
+        chunk_res = [f.result() for f in futures]
+
+        # Undo the round-robin assignment of queries to threads
+        res: List[QueryResult] = [None] * len(queries)  # type: ignore
+        for i in range(n):
+            res[i::n] = chunk_res[i]
+        return res
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
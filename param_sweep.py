@@ -0,0 +1,147 @@
+'''
+Run the same `MySolver` model under many parameter settings. The base problem
+is sent once to each of a few persistent worker processes (see `session`).
+Each grid point is then checked incrementally by adding `param == value`
+equalities in a scope that is popped afterwards, so the workers keep what
+they learned about the base problem. Every point's result is cached
+separately.
+'''
+
+from .cache import QueryResult, cache_fname, cfg_defaults, expr_to_smt2,\
+    fill_obj_from_dict, read_cached, write_cached
+from .my_solver import MySolver
+from .session import SessionWorker
+import os
+import queue as queue_mod
+import threading
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+from z3 import ExprRef
+
+# One entry per grid point: (index in the grid, cache file name, equalities)
+Task = Tuple[int, str, List[str]]
+
+
+def sweep_thread(tasks: "queue_mod.Queue[List[Task]]",
+                 results: "queue_mod.Queue[Tuple[Optional[int], Any]]",
+                 stop: threading.Event, base_list: List[str],
+                 track_unsat: bool, c, timeout: float, grace: float):
+    ''' Drives one worker process until `tasks` is empty or `stop` is set.
+    Puts `(index in grid, QueryResult)` on `results` for every point, or
+    `(index, exception)` if something goes wrong. Does not touch any z3
+    object, since z3 contexts are not thread safe '''
+    i = None
+    try:
+        worker = SessionWorker(
+            [("add", e, j) for (j, e) in enumerate(base_list)],
+            track_unsat, c.minimize_core, grace)
+        try:
+            while not stop.is_set():
+                try:
+                    chunk = tasks.get_nowait()
+                except queue_mod.Empty:
+                    break
+                for (i, fname, eqs) in chunk:
+                    if stop.is_set():
+                        break
+                    worker.push()
+                    for (j, e) in enumerate(eqs):
+                        worker.send(("add", e, len(base_list) + j))
+                    satisfiable, model, core, timed_out = worker.check(timeout)
+                    worker.pop()
+                    if core is not None:
+                        # Drop the parameter equalities
+                        core = [j for j in core if j < len(base_list)]
+
+                    if timed_out:
+                        res = QueryResult("unknown", None, timeout, c, None)
+                    else:
+                        res = QueryResult(satisfiable, model, None, c, None,
+                                          core,
+                                          core is not None and c.minimize_core)
+                    write_cached(fname, res)
+                    results.put((i, res))
+        finally:
+            worker.close()
+    except Exception as e:
+        results.put((i, e))
+
+
+def sweep(
+    c,
+    s: MySolver,
+    params: List[ExprRef],
+    grid: Sequence[Sequence[Any]],
+    v=None,
+    timeout: float = 10,
+    dir: str = "cached",
+    num_workers: Optional[int] = None,
+    chunk_size: int = 8,
+    grace: float = 5
+) -> Iterator[Tuple[int, Sequence[Any], QueryResult]]:
+    '''Check `s` with `params[k] == point[k]` for every `point` in `grid`.
+    Yields one row `(index in grid, point, result)` per point, in the order
+    they finish. Cached points are yielded first. If the caller stops
+    iterating, the workers stop after the points they are solving. An
+    exception raised while solving is re-raised here.
+
+    Contiguous chunks of `chunk_size` points are handed to `num_workers`
+    worker processes, so neighboring points are solved incrementally by the
+    same worker. `timeout` is per point. `c`, `v` and `dir` are as in
+    `run_query`.
+
+    '''
+
+    track_unsat = cfg_defaults(c, s)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    base_smt2 = s.to_smt2()
+    base_list = [expr_to_smt2(e) for e in s.assertion_list]
+
+    tasks: "queue_mod.Queue[List[Task]]" = queue_mod.Queue()
+    chunk: List[Task] = []
+    num_pending = 0
+    for (i, point) in enumerate(grid):
+        assert len(point) == len(params)
+        eqs = [expr_to_smt2(p == val) for (p, val) in zip(params, point)]
+        fname = cache_fname(base_smt2 + "\n; sweep\n" + "".join(eqs), dir)
+        cached = read_cached(fname, timeout, track_unsat, c.minimize_core)
+        if cached is not None:
+            yield (i, point, fill_result(cached, v))
+            continue
+        chunk.append((i, fname, eqs))
+        num_pending += 1
+        if len(chunk) == chunk_size:
+            tasks.put(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        tasks.put(chunk)
+
+    if num_pending == 0:
+        return
+
+    results: "queue_mod.Queue[Tuple[Optional[int], Any]]" = queue_mod.Queue()
+    stop = threading.Event()
+    threads = [threading.Thread(target=sweep_thread,
+                                args=(tasks, results, stop, base_list,
+                                      track_unsat, c, timeout, grace))
+               for _ in range(min(num_workers, tasks.qsize()))]
+    for t in threads:
+        t.start()
+    try:
+        for _ in range(num_pending):
+            (i, res) = results.get()
+            if isinstance(res, Exception):
+                raise res
+            yield (i, grid[i], fill_result(res, v))
+    finally:
+        # Also runs when the caller stops iterating early
+        stop.set()
+        for t in threads:
+            t.join()
+
+
+def fill_result(res: QueryResult, v) -> QueryResult:
+    if res.satisfiable == "sat":
+        res.v = fill_obj_from_dict(v, res.model)
+    return res
@@ -0,0 +1,238 @@
+'''
+Optional preprocessing of a `MySolver` before it is serialized by
+`run_query`. Constraints built by `Piecewise`, `IfStmt`, `Min` and `Max`
+repeat the same guards and subterms many times across assertions. z3 shares
+subterms within one assertion when printing SMT2, but not across assertions.
+This stage names every subterm shared across assertions once, drops duplicate
+assertions and optionally runs a z3 tactic chain. Models of the preprocessed
+problem can be mapped back to the original variables.
+'''
+
+from .cache import ModelDict, QueryResult, fill_obj_from_dict, model_to_dict
+from .common import logger
+from .my_solver import MySolver
+from fractions import Fraction
+from typing import Dict, List, Optional, Tuple
+import z3
+from z3 import Const, Context, Goal, Solver, Then, is_quantifier, substitute
+
+# Prefix of the constants that name shared subterms
+DEF_PREFIX = "__cse_"
+
+
+class Preprocessed:
+    '''Result of `preprocess`. `s` is the preprocessed solver, which has its
+    own context. The statistics
+    describe the size reduction. `index_map[i]` is the index in the original
+    `assertion_list` of the i-th assertion of `s.assertion_list`, or None if
+    it is a definition of a shared subterm or was produced by a tactic. The
+    first `num_defs` assertions are the definitions'''
+
+    s: MySolver
+    index_map: List[Optional[int]]
+    num_assertions: int
+    num_new_assertions: int
+    num_defs: int
+    orig_size: int
+    new_size: int
+    # The SMT2 of the assertions of `s`, in order and without unsat core
+    # tracking literals
+    smt2: str
+    # The goal produced by the tactics, if any. Used to map models back
+    goal: Optional[Goal]
+
+    def map_model(self, model: ModelDict) -> ModelDict:
+        '''Map a model of the preprocessed problem to the original variables'''
+        model = {k: val for (k, val) in model.items()
+                 if not k.startswith(DEF_PREFIX)}
+        if self.goal is None:
+            return model
+
+        # Rebuild the model in z3 so the tactics' model converter can fill in
+        # the variables they eliminated
+        s = Solver(ctx=self.s.ctx)
+        for (name, val) in model.items():
+            if type(val) == bool:
+                s.add(z3.Bool(name, ctx=self.s.ctx) == val)
+            elif type(val) == int:
+                s.add(z3.Int(name, ctx=self.s.ctx) == val)
+            else:
+                assert isinstance(val, Fraction)
+                s.add(z3.Real(name, ctx=self.s.ctx) == z3.RealVal(val, self.s.ctx))
+        assert s.check() == z3.sat
+        return model_to_dict(self.goal.convert_model(s.model()))
+
+    def map_result(self, res: QueryResult, v) -> QueryResult:
+        '''Map a result for the preprocessed problem to one for the original
+        problem. `v` is as in `run_query`'''
+        if res.satisfiable == "sat":
+            model = self.map_model(res.model)
+            return QueryResult("sat", model, None, res.c,
+                               fill_obj_from_dict(v, model))
+        core = getattr(res, "unsat_core", None)
+        if core is not None:
+            # Definitions can always be satisfied, so they can be dropped
+            # from a core. An assertion produced by a tactic has no
+            # counterpart in the original problem, so the core is lost
+            core = [i for i in core if i >= self.num_defs]
+            if any(self.index_map[i] is None for i in core):
+                core = None
+            else:
+                core = sorted(set(self.index_map[i] for i in core))
+        return QueryResult(res.satisfiable, None, res.timeout, res.c, None,
+                           core, getattr(res, "core_minimized", False))
+
+    def report(self) -> str:
+        return (f"Preprocessing: {self.num_assertions} -> "
+                f"{self.num_new_assertions} assertions ({self.num_defs} shared "
+                f"subterms), SMT2 size {self.orig_size} -> {self.new_size}")
+
+
+def count_refs(e, counts: Dict[int, int], sizes: Dict[int, int],
+               terms: Dict[int, z3.ExprRef], order: List[int]):
+    ''' Count the references to every subterm of `e`, treating `e` as a DAG.
+    `sizes` receives the size of every subterm as a tree. `order` receives
+    subterm ids children-first '''
+    stack = [(e, False)]
+    while len(stack) > 0:
+        (x, expanded) = stack.pop()
+        i = x.get_id()
+        if expanded:
+            sizes[i] = 1 + sum(sizes[ch.get_id()] for ch in x.children())
+            order.append(i)
+            continue
+        counts[i] = counts.get(i, 0) + 1
+        if counts[i] > 1:
+            continue
+        terms[i] = x
+        # Do not name terms under binders, since they may contain bound
+        # variables
+        if is_quantifier(x):
+            sizes[i] = 1
+            continue
+        stack.append((x, True))
+        for ch in x.children():
+            stack.append((ch, False))
+
+
+def share_subterms(assertions: List[z3.ExprRef], def_cost: int)\
+        -> Tuple[List[z3.ExprRef], List[z3.ExprRef]]:
+    '''Name the subterms shared across `assertions` that are worth naming.
+    Returns the definitions and the rewritten assertions'''
+    counts: Dict[int, int] = {}
+    sizes: Dict[int, int] = {}
+    terms: Dict[int, z3.ExprRef] = {}
+    order: List[int] = []
+    for e in assertions:
+        count_refs(e, counts, sizes, terms, order)
+    top = set(e.get_id() for e in assertions)
+
+    # Size of every subterm once the shared subterms in it are named
+    new_sizes: Dict[int, int] = {}
+    # Children first, so a definition can refer to the names of its shared
+    # subterms
+    defs = []
+    pairs = []
+    for i in order:
+        x = terms[i]
+        if is_quantifier(x):
+            new_sizes[i] = 1
+            continue
+        new_sizes[i] = 1 + sum(new_sizes[ch.get_id()] for ch in x.children())
+        # Naming saves all but one copy of the subterm. It costs a
+        # reference per use, about two nodes' worth of text each, plus the
+        # declaration and assertion of the definition
+        if counts[i] < 2 or i in top or\
+                (counts[i] - 1) * new_sizes[i] <= def_cost + 2 * counts[i]:
+            continue
+        name = Const(f"{DEF_PREFIX}{len(pairs)}", x.sort())
+        body = x.decl()(*[substitute(ch, *pairs) if len(pairs) > 0 else ch
+                          for ch in x.children()])
+        defs.append(name == body)
+        pairs.append((x, name))
+        new_sizes[i] = 1
+    if len(pairs) > 0:
+        assertions = [substitute(e, *pairs) for e in assertions]
+    return defs, assertions
+
+
+def preprocess(s: MySolver, tactics: Optional[List[str]] = None,
+               share: bool = True, def_cost: int = 2,
+               track_unsat: Optional[bool] = None) -> Preprocessed:
+    '''Preprocess the assertions in `s` into a new solver in a new context.
+    `s` itself is only read, so its SMT2 (and hence its cache key) stays the
+    same. `tactics` is a list of z3 tactic names (e.g. ["simplify",
+    "propagate-values", "solve-eqs"]) that is applied first. Tactics are
+    skipped when tracking unsat cores, since they do not preserve the mapping
+    to the original assertions. If `share`, subterms shared across assertions
+    are named when that makes the SMT2 smaller. `def_cost` is roughly the
+    cost of declaring and asserting a definition, measured in nodes. z3
+    `let`-binds the nodes shared within an assertion, which makes each of
+    them worth a lot of text.
+    `track_unsat` is whether unsat cores will be tracked. It defaults to
+    `s.track_unsat`.
+
+    '''
+    if track_unsat is None:
+        track_unsat = s.track_unsat
+    ctx = Context()
+    res = Preprocessed()
+    res.num_assertions = len(s.assertion_list)
+    res.orig_size = len(s.to_smt2())
+    res.goal = None
+
+    # Drop duplicate (and trivially true) assertions
+    assertions = []
+    index_map: List[Optional[int]] = []
+    seen = set()
+    for (i, e) in enumerate(s.assertion_list):
+        if type(e) == bool:
+            if e:
+                continue
+            e = z3.BoolVal(e, s.ctx)
+        if e.get_id() in seen:
+            continue
+        seen.add(e.get_id())
+        assertions.append(e.translate(ctx))
+        index_map.append(i)
+    del seen
+
+    if tactics is not None and len(tactics) > 0 and not track_unsat:
+        g = Goal(ctx=ctx)
+        g.add(*assertions)
+        tactic = Then(*tactics, ctx=ctx) if len(tactics) > 1\
+            else z3.Tactic(tactics[0], ctx=ctx)
+        subgoals = tactic(g)
+        if len(subgoals) == 1:
+            res.goal = subgoals[0]
+            assertions = [res.goal.get(i) for i in range(res.goal.size())]
+            index_map = [None] * len(assertions)
+        else:
+            logger.warning("Tactics %s produced %d subgoals. Ignoring them",
+                           tactics, len(subgoals))
+
+    defs: List[z3.ExprRef] = []
+    if share:
+        defs, assertions = share_subterms(assertions, def_cost)
+
+    res.s = MySolver(ctx)
+    res.s.variables = set(s.variables)
+    # The original assertions were already checked. Tactics and sharing
+    # introduce new constants, which are declared automatically
+    res.s.warn_undeclared = False
+    if track_unsat:
+        res.s.set(unsat_core=True)
+    # Without tracking literals, for `run_query` to hash and ship
+    plain = Solver(ctx=ctx)
+    for e in defs + assertions:
+        res.s.add(e)
+        plain.add(e)
+    res.index_map = [None] * len(defs) + index_map
+    res.num_defs = len(defs)
+    res.num_new_assertions = len(res.s.assertion_list)
+    # z3 introduces `let`s for terms it sees multiple references to, so drop
+    # ours before printing the result
+    del defs, assertions
+    res.smt2 = plain.to_smt2()
+    res.new_size = len(res.smt2)
+    return res
@@ -0,0 +1,215 @@
+'''
+Keeps a z3 solver alive in a worker process across many related queries.
+Unlike `run_query`, which rebuilds the whole problem in a new process every
+time, a session ships the base problem once and then only sends
+`add`/`push`/`pop` deltas over a pipe. Timeouts are enforced with the solver's
+`timeout` parameter, so what the solver learned survives across queries.
+Results still go through the same cache as `run_query`.
+'''
+
+from .cache import ModelDict, QueryResult, add_tracked, cache_fname,\
+    cfg_defaults, core_indices, expr_to_smt2, fill_obj_from_dict,\
+    model_to_dict, read_cached, write_cached
+from .common import logger
+from .my_solver import MySolver
+import multiprocessing as mp
+from typing import List, Optional, Tuple
+from z3 import BoolRef, Solver, parse_smt2_string
+
+
+def session_worker(conn, track_unsat: bool, minimize: bool):
+    s = Solver()
+    s.set(unsat_core=track_unsat)
+    labels: List[BoolRef] = []
+    # Number of labels at each push
+    frames: List[int] = []
+    while True:
+        cmd = conn.recv()
+        if cmd[0] == "add":
+            _, e, i = cmd
+            add_tracked(s, parse_smt2_string(e)[0], i, track_unsat, labels)
+        elif cmd[0] == "push":
+            s.push()
+            frames.append(len(labels))
+        elif cmd[0] == "pop":
+            s.pop()
+            del labels[frames.pop():]
+        elif cmd[0] == "check":
+            _, timeout = cmd
+            s.set(timeout=int(timeout * 1000))
+            satisfiable = str(s.check(*labels))
+            model = None
+            core = None
+            timed_out = False
+            if satisfiable == "sat":
+                model = model_to_dict(s.model())
+            elif satisfiable == "unsat" and track_unsat:
+                core = core_indices(s, minimize)
+            else:
+                timed_out = s.reason_unknown() in ["timeout", "canceled"]
+            conn.send((satisfiable, model, core, timed_out))
+        elif cmd[0] == "close":
+            break
+        else:
+            assert False, f"Unknown session command {cmd[0]}"
+    conn.close()
+
+
+class SessionWorker:
+    ''' A `session_worker` process and the deltas that make up its state, so
+    that a fresh worker can be brought up to date. Deltas in popped scopes
+    are dropped. Does not touch any z3 object, so it can be driven from any
+    thread.
+
+    If the worker dies, or does not respond within `grace` seconds after a
+    check's timeout (z3 does not always honor the timeout promptly), it is
+    killed and a new one is started by replaying the deltas.
+    '''
+
+    def __init__(self, log: List[Tuple], track_unsat: bool, minimize: bool,
+                 grace: float = 5):
+        ''' `log` holds the deltas that build the base problem '''
+        self.log = log
+        # Length of `log` at each open `push`
+        self.log_frames: List[int] = []
+        self.track_unsat = track_unsat
+        self.minimize = minimize
+        self.grace = grace
+        self.proc: Optional[mp.Process] = None
+        self.start()
+
+    def start(self):
+        self.conn, child_conn = mp.Pipe()
+        self.proc = mp.Process(
+            target=session_worker,
+            args=(child_conn, self.track_unsat, self.minimize))
+        self.proc.start()
+        child_conn.close()
+        for cmd in self.log:
+            self.conn.send(cmd)
+
+    def restart(self):
+        assert self.proc is not None, "Session is closed"
+        self.proc.terminate()
+        self.proc.join()
+        self.proc.close()
+        self.conn.close()
+        self.start()
+
+    def send_unlogged(self, cmd: Tuple):
+        try:
+            self.conn.send(cmd)
+        except OSError:
+            # The worker died. `log` already reflects `cmd`
+            logger.warning("Solver session died. Restarting it")
+            self.restart()
+
+    def send(self, cmd: Tuple):
+        self.log.append(cmd)
+        self.send_unlogged(cmd)
+
+    def push(self):
+        self.log_frames.append(len(self.log))
+        self.send(("push",))
+
+    def pop(self):
+        del self.log[self.log_frames.pop():]
+        self.send_unlogged(("pop",))
+
+    def check(self, timeout: float) -> Tuple[str, Optional[ModelDict],
+                                             Optional[List[int]], bool]:
+        ''' Returns (satisfiable, model, unsat core, whether it timed out) '''
+        assert self.proc is not None, "Session is closed"
+        # If the worker died before answering, try once more with a new one
+        for retry in [True, False]:
+            try:
+                self.conn.send(("check", timeout))
+                if self.conn.poll(timeout + self.grace):
+                    return self.conn.recv()
+                logger.warning("Solver session unresponsive. Restarting it")
+                retry = False
+            except (EOFError, OSError):
+                logger.warning("Solver session died. Restarting it")
+            self.restart()
+            if not retry:
+                break
+        return "unknown", None, None, True
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.conn.send(("close",))
+        except OSError:
+            pass
+        self.proc.join()
+        self.proc.close()
+        self.conn.close()
+        self.proc = None
+
+
+class SolverSession:
+    ''' A `MySolver` whose checks run incrementally in a persistent worker
+    process (see `SessionWorker`). Declare variables with `self.s` and make
+    all assertions and scope changes through the session so that they reach
+    the worker.
+    '''
+
+    def __init__(self, c, s: Optional[MySolver] = None, dir: str = "cached",
+                 grace: float = 5):
+        ''' `s` is the base problem. The session takes ownership of it. `c` and
+        `dir` are as in `run_query` '''
+        if s is None:
+            s = MySolver()
+        self.c = c
+        self.s = s
+        self.dir = dir
+        self.track_unsat = cfg_defaults(c, s)
+        self.worker = SessionWorker(
+            [("add", expr_to_smt2(e), i) for (i, e) in enumerate(s.assertion_list)],
+            self.track_unsat, c.minimize_core, grace)
+
+    def add(self, expr):
+        self.s.add(expr)
+        self.worker.send(("add", expr_to_smt2(expr),
+                          len(self.s.assertion_list) - 1))
+
+    def push(self):
+        self.s.push()
+        self.worker.push()
+
+    def pop(self):
+        self.s.pop()
+        self.worker.pop()
+
+    def check(self, v=None, timeout: float = 10) -> QueryResult:
+        ''' Check the current assertions. `v` and `timeout` are as in
+        `run_query` '''
+        fname = cache_fname(self.s.to_smt2(), self.dir)
+        logger.debug("Cache file name: %s", fname)
+        cached = read_cached(fname, timeout, self.track_unsat,
+                             self.c.minimize_core)
+        if cached is not None:
+            return cached
+
+        satisfiable, model, core, timed_out = self.worker.check(timeout)
+        if timed_out:
+            res = QueryResult("unknown", None, timeout, self.c, None)
+        elif satisfiable == "sat":
+            res = QueryResult(satisfiable, model, None, self.c,
+                              fill_obj_from_dict(v, model))
+        else:
+            res = QueryResult(satisfiable, model, None, self.c, None, core,
+                              core is not None and self.c.minimize_core)
+
+        write_cached(fname, res)
+        return res
+
+    def close(self):
+        self.worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,18 +1,84 @@
 ''' Produce solutions with small denominators '''
 
 from fractions import Fraction
-import logging
-import math
-from typing import Set, Optional, Tuple
-from z3 import CheckSatResult, If, Or, Real, ModelRef
+from typing import Dict, List, Set, Optional, Tuple
+from z3 import CheckSatResult, If, Or, Real, RealVal, ModelRef, is_true,\
+    substitute
 
 from .binary_search import BinarySearch
 from .cache import ModelDict, model_to_dict
-from .common import GlobalConfig
-from .my_solver import MySolver
+from .common import logger
+from .my_solver import MySolver, extract_vars
+
+
+def best_approximations(val: Fraction,
+                        max_denom: int) -> Tuple[Fraction, Fraction]:
+    '''The closest fractions to `val` from below and above whose denominator is
+    at most `max_denom`. Any fraction strictly between the two has a larger
+    denominator. Computed from the continued fraction of `val`, like
+    `Fraction.limit_denominator`'''
+    if val.denominator <= max_denom:
+        return val, val
+    p0, q0, p1, q1 = 0, 1, 1, 0
+    n, d = val.numerator, val.denominator
+    while True:
+        a = n // d
+        q2 = q0 + a * q1
+        if q2 > max_denom:
+            break
+        p0, q0, p1, q1 = p1, q1, p0 + a * p1, q2
+        n, d = d, n - a * d
+    k = (max_denom - q0) // q1
+    # The last convergent and the best semiconvergent lie on opposite sides
+    # of `val`
+    bound1 = Fraction(p0 + k * p1, q0 + k * q1)
+    bound2 = Fraction(p1, q1)
+    return min(bound1, bound2), max(bound1, bound2)
+
+
+def snap_vars(s: MySolver,
+              m_model: ModelRef,
+              m: ModelDict,
+              max_denom: int,
+              target_vars: Optional[Set[str]]) -> Dict[str, Fraction]:
+    '''Without calling the solver, greedily move variables in the model to the
+    best small-denominator approximation of their value, one variable at a
+    time. A move is kept if every assertion mentioning the variable still
+    holds. Returns the new values of the variables that were moved.
+
+    '''
+    ctx = s.ctx
+    # The variables in each assertion and the assertions using each variable
+    vars_of: List[Set[str]] = []
+    uses: Dict[str, List[int]] = {}
+    for (i, e) in enumerate(s.assertion_list):
+        vars_of.append(set() if type(e) == bool else set(extract_vars(e)))
+        for var in vars_of[-1]:
+            uses.setdefault(var, []).append(i)
+
+    snapped: Dict[str, Fraction] = {}
+    pairs = {}
+    for vname in m:
+        if target_vars is not None and vname not in target_vars:
+            continue
+        val = m[vname]
+        if type(val) is not Fraction or val.denominator <= max_denom:
+            continue
+        lo, hi = best_approximations(val, max_denom)
+        for cand in sorted([lo, hi], key=lambda x: abs(x - val)):
+            pair = (Real(vname, ctx), RealVal(cand, ctx))
+
+            def holds(i: int) -> bool:
+                sub = [pairs[x] for x in vars_of[i] if x in pairs] + [pair]
+                e = substitute(s.assertion_list[i], *sub)
+                return is_true(m_model.eval(e, model_completion=True))
+
+            if all(holds(i) for i in uses.get(vname, [])):
+                pairs[vname] = pair
+                snapped[vname] = cand
+                break
+    return snapped
 
-logger = logging.getLogger('pyz3_utils')
-GlobalConfig().default_logger_setup(logger)
 
 def find_small_denom_soln(s: MySolver,
                           max_denom: int,
@@ -23,6 +89,10 @@ def find_small_denom_soln(s: MySolver,
     only on making the given variables (specified by their name) have a small
     denominator.
 
+    First tries to snap variables to small-denominator values without calling
+    the solver (see `snap_vars`). Only the variables that cannot be snapped
+    this way are handed to the solver-backed search.
+
     '''
 
     ctx = s.ctx
@@ -36,6 +106,27 @@ def find_small_denom_soln(s: MySolver,
     # Isolate the constraints this function adds from the outside.
     s.push()
 
+    orig_small = 0
+    for vname in m:
+        if (type(m[vname]) is Fraction and
+                (target_vars is None or vname in target_vars) and
+                m[vname].denominator <= max_denom):
+            orig_small += 1
+
+    snapped = snap_vars(s, m_model, m, max_denom, target_vars)
+    if len(snapped) > 0:
+        # The snapped assignment satisfies every assertion, so this check is
+        # cheap. It gives us a model for it
+        s.push()
+        for (vname, val) in snapped.items():
+            s.add(Real(vname, ctx) == val)
+        if str(s.check()) == "sat":
+            m_model = s.model()
+            m = model_to_dict(m_model)
+        else:
+            s.pop()
+            s.push()
+
     best_m_model = m_model
     best_m = m
     best_obj = 0
@@ -51,11 +142,9 @@ def find_small_denom_soln(s: MySolver,
             val = m[vname]
             assert isinstance(val, Fraction)
 
-            # Fractions just above and below the value
-            num = math.ceil(Fraction(val.numerator * max_denom,
-                                     val.denominator))
-            hi = Fraction(num, max_denom)
-            lo = Fraction(num - 1, max_denom)
+            # Closest fractions with a small denominator just above and below
+            # the value
+            lo, hi = best_approximations(val, max_denom)
             assert lo <= val and val <= hi, f"Error in computing hi={hi} and lo={lo} for {val}"
 
             # Value is either the original or a value just above or below the
@@ -70,11 +159,11 @@ def find_small_denom_soln(s: MySolver,
                 old_obj += 1
         else:
             if target_vars is not None:
-                logger.warn(f"Warning: `{vname}` present in `target_vars`, but its type is `{type(m[vname])}`, not `Fraction`")
+                logger.warning("`%s` present in `target_vars`, but its type is `%s`, not `Fraction`", vname, type(m[vname]))
 
 
     search = BinarySearch(0, max_objective, 1)
-    while True:
+    while max_objective > 0:
         pt = search.next_pt()
         if pt is None:
             break
@@ -101,7 +190,8 @@ def find_small_denom_soln(s: MySolver,
 
         s.pop()
 
-    search.get_bounds()
+    if max_objective > 0:
+        search.get_bounds()
 
     new_obj = 0
     for vname in best_m:
@@ -111,9 +201,11 @@ def find_small_denom_soln(s: MySolver,
             assert isinstance(val, Fraction)
             if val.denominator <= max_denom:
                 new_obj += 1
-    logger.info(f"Improved number of small numbers from {old_obj} to {new_obj} out of a max of {old_obj + max_objective}")
+    logger.info("Improved number of small numbers from %d to %d out of a max of %d (%d without the solver)", orig_small, new_obj, old_obj + max_objective, len(snapped))
 
     # Remove all constraints we added
+    if len(snapped) > 0:
+        s.pop()
     s.pop()
     # s.check() This check might not return the best model... SO returning actual model also.
     return orig_sat, best_m, best_m_model